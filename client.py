@@ -7,23 +7,27 @@ Email:  andy@shady.org
 | Function: To facilitate connections to HTTPS REST API using API token
 """
 
-import six
+import asyncio
 import json
+import concurrent.futures
 import logging
+import math
 import requests
 import requests.auth
 import requests.adapters
 import requests.packages
 from requests.packages import urllib3
+from requests.packages.urllib3.util.retry import Retry
 import requests.exceptions
+import time
+import types
 import timeit
+import warnings
+import weakref
 from .errors import ClientError
 
+logger = logging.getLogger(__name__)
 
-if six.PY3:
-    long = int
-    unicode = str
-    basestring = str
 
 try:
     #############################################################################
@@ -34,18 +38,56 @@ try:
 except (ImportError, AttributeError):
     InsecureRequestWarning = None
 
+from urllib.parse import quote, urlencode
+
 try:
-    from urllib import quote
-except (ImportError, AttributeError):
-    from urllib.parse import quote
+    # orjson encodes straight to bytes, so requests skips its own encoding step
+    import orjson
+    json_loads = orjson.loads
+
+    def _non_finite(obj):
+        if isinstance(obj, float):
+            return not math.isfinite(obj)
+        if isinstance(obj, dict):
+            return any(_non_finite(x) for x in obj.values())
+        if isinstance(obj, (list, tuple)):
+            return any(_non_finite(x) for x in obj)
+        return False
+
+    def json_dumps(obj):
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # anything orjson refuses that the stdlib accepts, e.g. integers wider than 64 bits
+            return json.dumps(obj)
+        # orjson writes NaN/Infinity as null where the stdlib emits NaN/Infinity; only scan when a null shows up
+        if b'null' in data and _non_finite(obj):
+            return json.dumps(obj)
+        return data
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    # noinspection PyUnresolvedReferences
+    import h2
+    http2 = True
+except ImportError:
+    http2 = False
 
 
 class BearerAuth(requests.auth.AuthBase):
     def __init__(self, token):
         self.token = token
+        self._header = "Bearer " + token
 
     def __call__(self, r):
-        r.headers["authorization"] = "Bearer " + self.token
+        r.headers["authorization"] = self._header
         return r
 
 
@@ -53,7 +95,20 @@ class Client(object):
     """
     Connection class that simplifies and unifies all access to HTTPS API.
     """
-    def __init__(self, server, api_token, port=443, ssl_check=False, verbose=False, simulation=False):
+    # fixed attributes live in slots; __weakref__ is kept for the session finalizer
+    __slots__ = ('session', '_reply', '_error', '_error_bytes', '_error_code', '_record', '_params', '_async',
+                 'logger', 'debug', 'server', 'token', 'use_ssl', 'simulation', 'pool_connections', 'pool_maxsize',
+                 'token_ttl', '_token_valid_until', 'headers', 'url', '_url_prefix', '_verbs', '_finalizer',
+                 '__weakref__')
+
+    _HTTP_VERBS = frozenset(('get', 'post', 'put', 'delete', 'patch'))
+    _BODY_VERBS = frozenset(('post', 'put', 'patch'))
+    _WRAPPERS = {}
+    _RETRIES = 5
+    _RETRY_STATUSES = frozenset((502, 503, 504))
+
+    def __init__(self, server, api_token, port=443, ssl_check=False, verbose=False, simulation=False,
+                 pool_connections=20, pool_maxsize=100, token_ttl=300):
         """
         Standard constructor.
 
@@ -63,22 +118,26 @@ class Client(object):
         :param ssl_check: whether to perform SSL validation or not
         :param verbose: enable debugging (1 for INFO, 2 for DEBUG)
         :param simulation: enable simulation of call for testing
+        :param pool_connections: number of connection pools to cache
+        :param pool_maxsize: maximum number of connections to keep per pool
+        :param token_ttl: seconds after a login during which a 401 is not worth a re-auth
         """
         self.session = requests.Session()
         self._reply = None
         self._error = None
+        self._error_bytes = None
         self._error_code = None
         self._record = None
         self._params = None
+        self._async = None
 
-        logging.basicConfig(level=logging.ERROR)
-        self.logger = logging.getLogger()
-        self.logger.setLevel(logging.ERROR)
+        # the level is only touched when asked for; otherwise it inherits the application's configuration
+        self.logger = logger
         self.debug = verbose if verbose else 0
         if self.debug is True:
             self.logger.setLevel(logging.WARNING)
             self.logger.warning('Setting level to WARNING')
-        if self.debug == 2:
+        elif self.debug == 2:
             self.logger.setLevel(logging.INFO)
             self.logger.info('Setting level to INFO')
         elif self.debug > 2:
@@ -89,12 +148,24 @@ class Client(object):
         self.token = api_token
         self.use_ssl = True if ssl_check is True else False
         self.simulation = simulation
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.token_ttl = token_ttl
+        self._token_valid_until = 0
 
         # set up HTTP/S session
         self.session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=5, pool_connections=5, pool_maxsize=10)
+        # back off and retry on connection errors and gateway failures; the final
+        # response is handed back to query() rather than raised as a RetryError.
+        # read=False: a request that may already have reached the server is never resent
+        retries = Retry(total=self._RETRIES, read=False, backoff_factor=1, status_forcelist=self._RETRY_STATUSES,
+                        raise_on_status=False, allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE', 'PATCH']))
+        adapter = requests.adapters.HTTPAdapter(max_retries=retries, pool_connections=self.pool_connections,
+                                                pool_maxsize=self.pool_maxsize)
         self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        self.session.headers.update(self.headers)
 
         self.session.verify = False
         if self.use_ssl is True:
@@ -102,17 +173,34 @@ class Client(object):
 
         # prepare the URL
         self.url = 'https://{0}:{1}'.format(server, port)
-        self.session.auth = BearerAuth(self.token)
-        self.logger.debug('Infoblox Load Complete, loglevel set to %s', logging.getLevelName(self.logger.getEffectiveLevel()))
+        self._url_prefix = self.url + '/'
+        self._bind_verbs()
+        self._login()
+        self._finalizer = weakref.finalize(self, self.session.close)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Client Load Complete, loglevel set to %s', logging.getLevelName(self.logger.getEffectiveLevel()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aenter__(self):
+        return self
 
-    def __del__(self):
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+        self.close()
+
+    def close(self):
         """
-        Class destructor.
-        The destructor mainly takes care of "gracefully" terminating the session towards HTTP Server.
+        Gracefully terminate the session towards HTTP Server.
+        Also runs automatically once the client is garbage collected; use :meth:`aclose` for the async transport.
         """
-        if self.session:
-            self.session.close()
-            self.session = None
+        if self._async is not None:
+            warnings.warn('close() leaves the aquery() transport open; use aclose() or "async with"', ResourceWarning)
+        self._finalizer()
 
     def __getattr__(self, item):
         """
@@ -130,24 +218,27 @@ class Client(object):
         :param item: a self method
         :return: a wrapped query function or None
         """
-        opname = item.split('_')
+        func = self._WRAPPERS.get(item)
+        if func is not None:
+            return types.MethodType(func, self)
 
-        def func(*args, **kwargs):
-            fragments = None
-            if isinstance(args, (list, tuple)):
-                fragments = [x for x in opname[1:] if x]
-                fragments.extend([x for x in args if x])
-            elif isinstance(args, str):
-                fragments = [args]
+        opname = item.split('_')
+        if opname[0] not in self._HTTP_VERBS:
+            return None
+        verb = opname[0]
+        prefix = [x for x in opname[1:] if x]
 
+        def func(client, *args, **kwargs):
+            fragments = prefix + [x for x in args if x]
             if not fragments:
-                return self.query('', opname[0], **kwargs)
+                return client.query('', verb, **kwargs)
 
-            return self.query('/'.join(fragments), opname[0], **kwargs)
+            return client.query('/'.join(fragments), verb, **kwargs)
 
-        if opname[0] in ['get', 'post', 'put', 'delete', 'patch']:
-            return func
-        return None
+        # the wrapper depends only on the name, so one cached copy serves every instance
+        # without the instance holding a reference to itself
+        self._WRAPPERS[item] = func
+        return types.MethodType(func, self)
 
     def timeit(self, method, *args, **kwargs):
         """
@@ -167,7 +258,9 @@ class Client(object):
 
     @property
     def error_msg(self):
-        """ Method for storing and returning error messages """
+        """ Method for storing and returning error messages, decoded from the raw body on first access """
+        if self._error is None and self._error_bytes is not None:
+            self._error = self._error_bytes.decode('utf-8', 'replace')
         return self._error
 
     @property
@@ -179,25 +272,86 @@ class Client(object):
         """ Method for storing and returning reply messages """
         return self._reply
 
+    def _bind_verbs(self):
+        """ Map each HTTP verb to its bound session call and per-verb request options """
+        self._verbs = {
+            'get': (self.session.get, {'timeout': (10.0, 120)}),
+            'post': (self.session.post, {'timeout': (10.0, 30)}),
+            'put': (self.session.put, {'timeout': (10.0, 30)}),
+            'patch': (self.session.patch, {'timeout': (10.0, 30)}),
+            'delete': (self.session.delete, {'timeout': (10.0, 30)}),
+        }
+
     def _login(self):
         if not self.session:
             self.session = requests.Session()
+            self._bind_verbs()
         self.session.auth = BearerAuth(self.token)
+        self._token_valid_until = time.monotonic() + self.token_ttl
 
     def _parse_error(self, response):
         self.logger.debug('Parsing error response and raising exception')
-        self._error = response.text
+        self._error = None
+        self._error_bytes = response.content
         self._error_code = response.status_code
-        raise ClientError(self.__class__.__name__, self.error_code, self.error_msg)
+        # the exception text is built from this response alone so concurrent queries cannot mix it up;
+        # error_msg still decodes the stored bytes only when read
+        message = response.content.decode('utf-8', 'replace')
+        if response.status_code >= 400:
+            message = "HTTP Server Error: %s" % message
+        raise ClientError(self.__class__.__name__, response.status_code, message)
+
+    @staticmethod
+    def _json(response):
+        """ Decode a JSON body straight from bytes, leaving non UTF-8 charsets to the response itself """
+        encoding = response.encoding
+        if not encoding or encoding.lower().replace('_', '-') not in ('utf-8', 'utf8'):
+            return response.json()
+        try:
+            return json_loads(response.content)
+        except json.JSONDecodeError as e:
+            raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
 
     def _parse_response(self, response):
         if 200 <= response.status_code <= 299:
-            reply = dict(status_code=response.status_code, data=response.json())
+            reply = dict(status_code=response.status_code, data=self._json(response))
             return reply
         else:
             self.logger.debug('Response is not good, parsing error...')
             return self._parse_error(response)
 
+    def _build_request(self, resource, method, payload, kwargs):
+        """
+        Normalise the HTTP verb and craft the final URL and payload for a query.
+
+        :return: tuple of (method, url, payload)
+        :rtype: tuple
+        """
+        method = method.strip().lower()
+        resource = resource.strip().lstrip('/')
+        self._error = None
+        self._error_bytes = None
+
+        if method not in self._HTTP_VERBS:
+            method = 'get'
+
+        if kwargs and method not in self._BODY_VERBS:
+            query = urlencode(kwargs, doseq=True, safe='/', quote_via=quote)
+            self.logger.debug('Query: %s', query)
+            resource = resource + '?' + query
+        elif kwargs and method in self._BODY_VERBS and not payload:
+            payload = kwargs
+
+        if resource and resource[0] != '?':
+            url = self._url_prefix + resource
+        else:
+            url = self.url + resource
+
+        self.logger.info('Final URL: %s, Method: %s', url, method)
+        if payload and payload is not None:
+            self.logger.debug('Payload: %s', payload)
+        return method, url, payload
+
     def query(self, resource, method='get', payload='', **kwargs):
         """
         Wrapper method to join all the REST stuff in a single place.
@@ -215,70 +369,172 @@ class Client(object):
         :return: Result dictionary on success; False on error.
         :rtype: dict
         """
-        method = method.strip().lower()
-        resource = resource.strip()
-        self._error = None
+        if self.simulation:
+            # answer before any URL or query string work is done
+            if kwargs and not payload and method.strip().lower() in self._BODY_VERBS:
+                payload = kwargs
+            return dict(status_code=200, data=payload, ok=1)
 
-        http_verbs = ['get', 'post', 'put', 'delete', 'patch']
-        if method not in http_verbs:
-            method = 'get'
+        method, url, payload = self._build_request(resource, method, payload, kwargs)
+
+        try:
+            fn, opts = self._verbs[method]
+            options = dict(opts, verify=self.use_ssl)
+            if method in self._BODY_VERBS:
+                options['data'] = json_dumps(payload)
+            # work on a local reply so concurrent queries (see bulk()) never read each other's
+            reply = fn(url, **options)
+            if reply.status_code == 401 and time.monotonic() >= self._token_valid_until:
+                # resend the already-built request once instead of re-entering query()
+                self.logger.debug('Attempting Re-Auth')
+                self._login()
+                reply = self._verbs[method][0](url, **options)
+        except (requests.ConnectionError, requests.exceptions.SSLError, requests.exceptions.Timeout, requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout) as e:
+            error = "HTTP Server Error: {0} - {1}".format(e, url)
+            if e.response and e.response.status_code:
+                raise ClientError(self.__class__.__name__, e.response.status_code, error)
+            else:
+                raise ClientError(self.__class__.__name__, 503, error)
+
+        self._reply = reply
+        return self._parse_response(reply)
+
+    def prepared(self, resource, method='get', payload='', **kwargs):
+        """
+        Build a request once so it can be re-sent with :meth:`send`, skipping URL, header and body
+        construction on repeat calls. Callers may mutate ``prepared.url`` in place, e.g. for pagination.
 
-        if kwargs and method not in ['post', 'put', 'patch']:
-            query = '&'.join({quote(x) + '=' + quote(str(kwargs.get(x))) for x in kwargs})
-            self.logger.debug('Query: %s', query)
-            resource = resource + '?' + query
-        elif kwargs and method in ['post', 'put', 'patch'] and not payload:
-            payload = kwargs
+        .. code-block:: python
+            req = client.prepared('/devices', page=1)
+            first = client.send(req)
 
-        if resource:
-            resource = resource.strip() if resource.strip()[0] != '/' else resource.strip()[1:]
-            url = self.url + ('/' if resource[0] != '?' else '') + resource
-        else:
-            url = self.url
+        :param resource: string containing the endpoint name. Eg. ``/v3/some-call/get_them_all``
+        :type resource: str
+        :param method: string containing either 'get', 'post', 'put' or 'delete'. Defaults to 'get'.
+        :type method: str
+        :param payload: Python dictionary that gets send as a json string.
+        :type payload: dict
+        :return: request prepared against the session's headers
+        :rtype: requests.PreparedRequest
+        """
+        method, url, payload = self._build_request(resource, method, payload, kwargs)
+        request = requests.Request(method.upper(), url)
+        if method in self._BODY_VERBS:
+            request.data = json_dumps(payload)
+        return self.session.prepare_request(request)
 
-        self.logger.info('Final URL: %s, Method: %s', url, method)
-        if payload and payload is not None:
-            self.logger.debug('Payload: %s', payload)
+    def send(self, prepared):
+        """
+        Send a request built by :meth:`prepared` and parse the reply like :meth:`query`.
+
+        :param prepared: request returned by :meth:`prepared`
+        :type prepared: requests.PreparedRequest
+        :return: Result dictionary on success
+        :rtype: dict
+        """
+        if self.simulation:
+            return dict(status_code=200, data=json_loads(prepared.body) if prepared.body else '', ok=1)
 
+        self._error = None
+        self._error_bytes = None
+        # the method may have been changed in place; fall back to the write timeout for anything unknown
+        verb = self._verbs.get(prepared.method.lower())
+        timeout = verb[1]['timeout'] if verb else (10.0, 30)
+        try:
+            reply = self.session.send(prepared, verify=self.use_ssl, timeout=timeout)
+        except (requests.ConnectionError, requests.exceptions.Timeout) as e:
+            raise ClientError(self.__class__.__name__, 503, "HTTP Server Error: {0} - {1}".format(e, prepared.url))
+        self._reply = reply
+        return self._parse_response(reply)
+
+    def bulk(self, calls, max_workers=16):
+        """
+        Run many queries concurrently over the shared, connection-pooled session.
+
+        .. code-block:: python
+            client.bulk([dict(resource='/devices/4'), dict(resource='/devices', method='post', payload=dict(src='123'))])
+
+        .. note::
+            Each result belongs to its own call, but reply_msg, error_msg and error_code are shared,
+            so after a bulk call they reflect whichever query finished last.
+
+        :param calls: iterable of dicts holding the keyword arguments for each :meth:`query`
+        :type calls: list
+        :param max_workers: number of worker threads, capped at the connection pool size
+        :type max_workers: int
+        :return: list of result dictionaries, in the same order as calls
+        :rtype: list
+        """
+        max_workers = min(max_workers, self.pool_maxsize)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as ex:
+            return list(ex.map(lambda c: self.query(**c), calls))
+
+    def _async_client(self):
+        """ Lazily create the shared httpx.AsyncClient used by aquery() """
+        if httpx is None:
+            raise ClientError(self.__class__.__name__, 501, 'aquery() requires the httpx package')
+        if self._async is None:
+            headers = dict(self.headers)
+            headers['Authorization'] = 'Bearer ' + self.token
+            # the transport retries connection failures; aquery() handles gateway statuses itself
+            transport = httpx.AsyncHTTPTransport(http2=http2, verify=self.use_ssl, retries=self._RETRIES,
+                                                 limits=httpx.Limits(max_connections=self.pool_maxsize,
+                                                                     max_keepalive_connections=self.pool_maxsize))
+            self._async = httpx.AsyncClient(transport=transport, headers=headers)
+        return self._async
+
+    async def aquery(self, resource, method='get', payload='', **kwargs):
+        """
+        Coroutine counterpart of :meth:`query`, sent over a shared httpx.AsyncClient.
+        Concurrent calls are multiplexed over a few connections (HTTP/2 when h2 is installed).
+
+        .. code-block:: python
+            async with Client('example.com', 'my-api-token') as client:
+                results = await asyncio.gather(*[client.aquery('/devices', id=x) for x in ids])
+
+        :param resource: string containing the endpoint name. Eg. ``/v3/some-call/get_them_all``
+        :type resource: str
+        :param method: string containing either 'get', 'post', 'put' or 'delete'. Defaults to 'get'.
+        :type method: str
+        :param payload: Python dictionary that gets send as a json string.
+        :type payload: dict
+        :return: Result dictionary on success
+        :rtype: dict
+        """
         if self.simulation:
+            # answer before any URL or query string work is done
+            if kwargs and not payload and method.strip().lower() in self._BODY_VERBS:
+                payload = kwargs
             return dict(status_code=200, data=payload, ok=1)
 
-        attempts = 0
-        while attempts < 2:
-            try:
-                if method == 'get':
-                    self._reply = self.session.get(url, verify=self.use_ssl, timeout=(10.0, 120))
-                elif method == 'post':
-                    self._reply = self.session.post(url, verify=self.use_ssl, data=json.dumps(payload), headers=self.headers, timeout=(10.0, 30))
-                elif method == 'put':
-                    self._reply = self.session.put(url, verify=self.use_ssl, data=json.dumps(payload), headers=self.headers, timeout=(10.0, 30))
-                elif method == 'patch':
-                    self._reply = self.session.patch(url, verify=self.use_ssl, data=json.dumps(payload), headers=self.headers, timeout=(10.0, 30))
-                elif method == 'delete':
-                    self._reply = self.session.delete(url, verify=self.use_ssl, timeout=(10.0, 30))
-            except (requests.ConnectionError, requests.exceptions.SSLError, requests.exceptions.Timeout, requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout) as e:
-                error = "HTTP Server Error: {0} - {1}".format(e, url)
-                if e.response and e.response.status_code:
-                    raise ClientError(self.__class__.__name__, e.response.status_code, error)
-                else:
-                    raise ClientError(self.__class__.__name__, 503, error)
-            except requests.exceptions.HTTPError as exp:
-                if exp.response.status_code == 403 and attempts < 5:
-                    attempts += 1  # Try again because session timed out
-            break  # Do not try again
-
-        reauth = 0
-        while reauth <= 2:
-            if 401 == self._reply.status_code:
-                self.logger.debug('Attempting Re-Auth: %s attempt', reauth)
+        method, url, payload = self._build_request(resource, method, payload, kwargs)
+        client = self._async_client()
+
+        connect, read = self._verbs[method][1]['timeout']
+        options = dict(timeout=httpx.Timeout(read, connect=connect))
+        if method in self._BODY_VERBS:
+            options['content'] = json_dumps(payload)
+
+        try:
+            reply = await client.request(method.upper(), url, **options)
+            retries = 0
+            while reply.status_code in self._RETRY_STATUSES and retries < self._RETRIES:
+                # exponential backoff in step with the sync adapter's Retry(backoff_factor=1)
+                await asyncio.sleep(2 ** retries)
+                retries += 1
+                reply = await client.request(method.upper(), url, **options)
+            if reply.status_code == 401 and time.monotonic() >= self._token_valid_until:
+                self.logger.debug('Attempting Re-Auth')
                 self._login()
-                reauth += 1
-                return self.query(resource, method, payload, **kwargs)
-            break
-        # Validate response
-        if self._reply:
-            return self._parse_response(self._reply)
-        else:
-            self._error = "HTTP Server Error: %s" % self._reply.text
-            self._error_code = self._reply.status_code
-            raise ClientError(self.__class__.__name__, self.error_code, self.error_msg)
+                client.headers['Authorization'] = 'Bearer ' + self.token
+                reply = await client.request(method.upper(), url, **options)
+        except httpx.TransportError as e:
+            raise ClientError(self.__class__.__name__, 503, "HTTP Server Error: {0} - {1}".format(e, url))
+        self._reply = reply
+        return self._parse_response(reply)
+
+    async def aclose(self):
+        """ Close the async transport opened by :meth:`aquery` """
+        if self._async is not None:
+            await self._async.aclose()
+            self._async = None